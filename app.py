@@ -1,17 +1,32 @@
+import atexit
+import functools
 import hashlib
-import json
 import os
+import selectors
+import sqlite3
 import subprocess
 import sys
 import threading
-from queue import Queue
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
 from typing import Optional
 
-import chromadb
+import faiss
 import google.generativeai as genai
+import numpy as np
+import orjson
+import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
 
+from mcp_pagila_server import get_table_schema_impl as _get_table_schema
+from mcp_pagila_server import json_default
+from mcp_pagila_server import list_tables_impl as _list_tables
+from mcp_pagila_server import read_ndjson_stream
+from mcp_pagila_server import run_pagila_query_impl as _run_pagila_query
+
 # Set page config at the very top
 st.set_page_config(page_title="Pagila SQL Bot", layout="wide")
 
@@ -28,7 +43,15 @@ genai.configure(api_key=api_key)
 
 
 # --- MCP Server Helpers ---
-def _start_server() -> tuple[subprocess.Popen, Queue]:
+# "inprocess" (default) calls the server handlers directly; "stdio" spawns
+# mcp_pagila_server.py as a subprocess and exchanges JSON lines over its pipes.
+MCP_TRANSPORT = os.getenv("MCP_TRANSPORT", "inprocess").lower()
+
+# orjson writes bytes directly, so the MCP pipes are opened in binary mode.
+ORJSON_OPTS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC
+
+
+def _start_server() -> subprocess.Popen:
     script_path = os.path.join(
         os.path.dirname(os.path.abspath(__file__)), "mcp_pagila_server.py"
     )
@@ -38,31 +61,90 @@ def _start_server() -> tuple[subprocess.Popen, Queue]:
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        text=True,
-        bufsize=1,
+        text=False,
     )
 
-    stderr_q: Queue = Queue()
+    # No reader thread: stderr is drained by _send_request while it waits
+    assert proc.stderr is not None
+    os.set_blocking(proc.stderr.fileno(), False)
+    return proc
 
-    def _forward_stderr():
-        assert proc.stderr is not None
-        for ln in proc.stderr:
-            line = ln.rstrip("\n")
-            # keep server logs visible in console for local debugging
-            print("[mcp-server-stderr] " + line, file=sys.stderr)
-            try:
-                stderr_q.put_nowait(line)
-            except Exception:
-                pass
 
-    t = threading.Thread(target=_forward_stderr, daemon=True)
-    t.start()
-    return proc, stderr_q
+# Server stderr is echoed to the console in bulk, one write and flush per
+# drain instead of one print() per line.
+STDERR_PREFIX = b"[mcp-server-stderr] "
+
+
+def _drain_stderr(proc: subprocess.Popen) -> bool:
+    """Read whatever the server has written to stderr without blocking.
+
+    Returns False once stderr has reached EOF.
+    """
+    assert proc.stderr is not None
+    buf = bytearray()
+    open_ = True
+    while True:
+        try:
+            chunk = os.read(proc.stderr.fileno(), 65536)
+        except BlockingIOError:
+            break
+        if not chunk:
+            open_ = False
+            break
+        buf += chunk
+    if buf:
+        # keep server logs visible in console for local debugging
+        out = sys.stderr.buffer
+        out.write(b"".join(STDERR_PREFIX + ln for ln in buf.splitlines(keepends=True)))
+        out.flush()
+    return open_
+
+
+class _ResponseReader:
+    """Read response lines from the server's stdout, forwarding its stderr.
+
+    A plain stdout.readline() deadlocks once the server fills the stderr pipe
+    (~64 KiB, e.g. with LOG_LEVEL=DEBUG) before answering, so both pipes are
+    polled together. Used for one request at a time: the server writes
+    nothing to stdout unprompted, so no bytes are left over between requests.
+    """
+
+    def __init__(self, proc: subprocess.Popen):
+        assert proc.stdout is not None and proc.stderr is not None
+        self.proc = proc
+        self._buf = bytearray()
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(proc.stdout, selectors.EVENT_READ)
+        self._sel.register(proc.stderr, selectors.EVENT_READ)
+
+    def readline(self) -> bytes:
+        stdout = self.proc.stdout
+        while True:
+            end = self._buf.find(b"\n") + 1
+            if end:
+                line = bytes(self._buf[:end])
+                del self._buf[:end]
+                return line
+            for key, _ in self._sel.select():
+                if key.fileobj is stdout:
+                    chunk = os.read(stdout.fileno(), 65536)
+                    if not chunk:
+                        # EOF: hand back any partial line (b"" if none)
+                        line = bytes(self._buf)
+                        self._buf.clear()
+                        return line
+                    self._buf += chunk
+                elif not _drain_stderr(self.proc):
+                    self._sel.unregister(self.proc.stderr)
+
+    def close(self) -> None:
+        self._sel.close()
 
 
 def _send_request(proc: subprocess.Popen, request: dict) -> Optional[dict]:
     assert proc.stdin is not None and proc.stdout is not None
-    line = json.dumps(request, default=str) + "\n"
+    line = orjson.dumps(request, default=str, option=ORJSON_OPTS) + b"\n"
+    _drain_stderr(proc)
     try:
         proc.stdin.write(line)
         proc.stdin.flush()
@@ -70,22 +152,64 @@ def _send_request(proc: subprocess.Popen, request: dict) -> Optional[dict]:
         st.error(f"Failed to write to MCP server stdin: {exc}")
         return None
 
+    reader = _ResponseReader(proc)
     try:
-        resp_line = proc.stdout.readline()
+        resp_line = reader.readline()
         if not resp_line:
             st.error("MCP server closed stdout or exited")
             return None
-        return json.loads(resp_line)
+        resp = orjson.loads(resp_line)
+        if isinstance(resp, dict) and "stream" in resp:
+            return _read_stream(reader, resp)
+        return resp
     except Exception as exc:
         st.error(f"Failed to read/parse MCP response: {exc}")
         return None
+    finally:
+        reader.close()
+        _drain_stderr(proc)
+
+
+def _read_stream(reader: _ResponseReader, header: dict) -> Optional[dict]:
+    """Collect NDJSON row lines until the closing (or error) object line."""
+    resp = read_ndjson_stream(reader, header)
+    if resp is None:
+        st.error("MCP server closed stdout or exited")
+    return resp
+
+
+def _call_server(request: dict) -> Optional[dict]:
+    """Dispatch an MCP request over the configured transport."""
+    if MCP_TRANSPORT == "stdio":
+        if request.get("method") == "run_pagila_query":
+            # Rows arrive as NDJSON while the server is still fetching them
+            params = {**(request.get("params") or {}), "stream": True}
+            request = {**request, "params": params}
+        return _send_request(st.session_state.mcp_proc, request)
+
+    method = request.get("method")
+    params = request.get("params") or {}
+    try:
+        if method == "list_tables":
+            result = _list_tables()
+        elif method == "get_table_schema":
+            result = _get_table_schema(params.get("table_names", []))
+        elif method == "run_pagila_query":
+            result = _run_pagila_query(params.get("query", ""))
+        else:
+            raise ValueError(f"Unknown method: {method}")
+    except Exception as exc:
+        return {"id": request.get("id"), "error": {"message": str(exc)}}
+
+    # Normalize like the stdio wire format (Decimal -> float, dates -> ISO) so
+    # tool results stay serializable when handed back to Gemini.
+    result = orjson.loads(orjson.dumps(result, default=json_default))
+    return {"id": request.get("id"), "result": result}
 
 
-# Initialize MCP Server in Session State
-if "mcp_proc" not in st.session_state:
-    proc, stderr_q = _start_server()
-    st.session_state.mcp_proc = proc
-    st.session_state.mcp_stderr_q = stderr_q
+# Initialize MCP Server in Session State (stdio transport only)
+if MCP_TRANSPORT == "stdio" and "mcp_proc" not in st.session_state:
+    st.session_state.mcp_proc = _start_server()
 
 # Initialize Session State for History and Usage
 if "chat_history" not in st.session_state:
@@ -97,6 +221,69 @@ if "last_executed_sql" not in st.session_state:
 if "last_execution_success" not in st.session_state:
     st.session_state.last_execution_success = False
 
+
+def _load_schema_snapshot() -> Optional[dict]:
+    """Fetch every public table and its columns once for the session."""
+    tables_resp = _call_server(
+        {"id": "list_tables", "method": "list_tables", "params": {}}
+    )
+    if not tables_resp or "result" not in tables_resp:
+        return None
+    tables = tables_resp["result"].get("tables", [])
+    if not tables:
+        return None
+
+    schema_resp = _call_server(
+        {
+            "id": "get_schema",
+            "method": "get_table_schema",
+            "params": {"table_names": tables},
+        }
+    )
+    if not schema_resp or "result" not in schema_resp:
+        return None
+    schema_rows = schema_resp["result"].get("schema_rows", [])
+
+    # Rows come back ordered by table_name, so groupby yields one run per table
+    columns = {
+        table: list(rows)
+        for table, rows in groupby(schema_rows, key=itemgetter("table_name"))
+    }
+    text = "\n".join(
+        f"{table}("
+        + ", ".join(f"{r['column_name']} {r['data_type']}" for r in rows)
+        + ")"
+        for table, rows in columns.items()
+    )
+    return {"tables": tables, "columns": columns, "text": text}
+
+
+# Retry a failed snapshot at most this often (seconds)
+SCHEMA_RETRY_INTERVAL = 60.0
+
+
+def get_schema_snapshot() -> Optional[dict]:
+    """Pagila's schema is static: snapshot it once per session, on first use.
+
+    Failures are remembered so an unreachable DB does not block every rerun
+    for PG_POOL_TIMEOUT; the load is retried after SCHEMA_RETRY_INTERVAL.
+    """
+    snapshot = st.session_state.get("schema_snapshot")
+    if snapshot is not None:
+        return snapshot
+    failed_at = st.session_state.get("schema_snapshot_failed_at")
+    if failed_at is not None and time.monotonic() - failed_at < SCHEMA_RETRY_INTERVAL:
+        return None
+
+    snapshot = _load_schema_snapshot()
+    if snapshot:
+        st.session_state.schema_snapshot = snapshot
+        st.session_state.pop("schema_snapshot_failed_at", None)
+    else:
+        st.session_state.schema_snapshot_failed_at = time.monotonic()
+    return snapshot
+
+
 # Pricing (USD per 1M tokens) - Approximate
 PRICING = {
     "models/gemini-1.5-flash": {"input": 0.075, "output": 0.30},
@@ -107,58 +294,224 @@ PRICING = {
 STATS_FILE = "usage_stats.json"
 
 
+# Usage stats are written at most once per interval, not on every turn
+STATS_FLUSH_INTERVAL = 5.0
+
+
 def load_global_stats():
     if os.path.exists(STATS_FILE):
         try:
-            with open(STATS_FILE, "r") as f:
-                return json.load(f)
-        except (IOError, json.JSONDecodeError):
+            with open(STATS_FILE, "rb") as f:
+                return orjson.loads(f.read())
+        except (IOError, orjson.JSONDecodeError):
             pass
     return {"input": 0, "output": 0, "total_cost": 0.0}
 
 
 def save_global_stats(stats):
-    with open(STATS_FILE, "w") as f:
-        json.dump(stats, f)
+    # Write-then-rename so concurrent sessions never see a partial file
+    tmp = f"{STATS_FILE}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(stats))
+    os.replace(tmp, STATS_FILE)
+
+
+def _flush_global_stats(writer: dict) -> None:
+    with writer["lock"]:
+        stats, writer["pending"], writer["timer"] = writer["pending"], None, None
+        if stats is not None:
+            save_global_stats(stats)
+
+
+@st.cache_resource
+def _stats_writer() -> dict:
+    # Shared across reruns and sessions; flushed one last time at exit
+    writer = {"lock": threading.Lock(), "pending": None, "timer": None}
+    atexit.register(_flush_global_stats, writer)
+    return writer
+
+
+def _mark_dirty(stats) -> None:
+    """Queue a snapshot of stats to be written by the next timed flush."""
+    writer = _stats_writer()
+    with writer["lock"]:
+        writer["pending"] = dict(stats)
+        if writer["timer"] is None:
+            timer = threading.Timer(
+                STATS_FLUSH_INTERVAL, _flush_global_stats, args=(writer,)
+            )
+            timer.daemon = True
+            writer["timer"] = timer
+            timer.start()
 
 
 # --- Vector DB Setup ---
+# Persistent storage in 'vector_store' folder: a flat inner-product index over
+# L2-normalized embeddings plus a parallel JSONL file of {id, question, sql}.
+SQL_CACHE_DIR = "vector_store"
+SQL_CACHE_INDEX = os.path.join(SQL_CACHE_DIR, "sql_cache.index")
+SQL_CACHE_ENTRIES = os.path.join(SQL_CACHE_DIR, "sql_cache.jsonl")
+EMBED_DIM = 768
+# Cosine similarity required for a hit. Very strict to prevent false positives
+SQL_CACHE_MIN_SCORE = 0.9
+
+
 @st.cache_resource
-def get_chroma_client():
-    # Persistent storage in 'vector_store' folder
-    return chromadb.PersistentClient(path="vector_store")
+def get_sql_cache() -> dict:
+    os.makedirs(SQL_CACHE_DIR, exist_ok=True)
+    entries = []
+    if os.path.exists(SQL_CACHE_ENTRIES):
+        with open(SQL_CACHE_ENTRIES, "rb") as f:
+            entries = [orjson.loads(line) for line in f if line.strip()]
+    if os.path.exists(SQL_CACHE_INDEX):
+        index = faiss.read_index(SQL_CACHE_INDEX)
+    else:
+        index = faiss.IndexFlatIP(EMBED_DIM)
+
+    # Entries are written before the index, so an interrupted add can leave
+    # the two files out of step; keep only the consistent prefix.
+    n = min(index.ntotal, len(entries))
+    if index.ntotal > n:
+        index.remove_ids(np.arange(n, index.ntotal, dtype="int64"))
+    if len(entries) > n:
+        del entries[n:]
+        with open(SQL_CACHE_ENTRIES, "wb") as f:
+            f.writelines(orjson.dumps(e) + b"\n" for e in entries)
+
+    return {
+        "index": index,
+        "entries": entries,
+        "ids": {e["id"] for e in entries},
+        "lock": threading.Lock(),
+    }
 
 
-if "chroma_client" not in st.session_state:
-    st.session_state.chroma_client = get_chroma_client()
-    st.session_state.sql_collection = (
-        st.session_state.chroma_client.get_or_create_collection(name="sql_cache")
-    )
+def _normalize_embedding(embedding) -> np.ndarray:
+    q = np.asarray(embedding, dtype="float32")
+    q /= np.linalg.norm(q)
+    return q[None, :]
+
+
+def sql_cache_lookup(embedding) -> Optional[str]:
+    cache = get_sql_cache()
+    with cache["lock"]:
+        if not cache["index"].ntotal:
+            return None
+        scores, ids = cache["index"].search(_normalize_embedding(embedding), 1)
+        if scores[0, 0] > SQL_CACHE_MIN_SCORE:
+            return cache["entries"][ids[0, 0]]["sql"]
+    return None
+
+
+def sql_cache_add(entry_id: str, question: str, sql: str, embedding) -> None:
+    cache = get_sql_cache()
+    with cache["lock"]:
+        if entry_id in cache["ids"]:
+            return
+        entry = {"id": entry_id, "question": question, "sql": sql}
+        with open(SQL_CACHE_ENTRIES, "ab") as f:
+            f.write(orjson.dumps(entry) + b"\n")
+        cache["index"].add(_normalize_embedding(embedding))
+        faiss.write_index(cache["index"], SQL_CACHE_INDEX)
+        cache["entries"].append(entry)
+        cache["ids"].add(entry_id)
+
 
 if "global_metrics" not in st.session_state:
     st.session_state.global_metrics = load_global_stats()
 
 
-def get_embedding(text):
+def _cache_key(text: str) -> str:
+    # Only used as a lookup key, so a fast 128-bit BLAKE2b digest is enough
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+# --- Embedding Cache ---
+EMBED_MODEL = "models/text-embedding-004"
+EMBED_CACHE_PATH = os.path.join("vector_store", "embed_cache.sqlite")
+
+
+@st.cache_resource
+def get_embed_cache():
+    # On-disk layer so embeddings survive Streamlit reruns and process restarts
+    os.makedirs(os.path.dirname(EMBED_CACHE_PATH), exist_ok=True)
+    conn = sqlite3.connect(EMBED_CACHE_PATH, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings"
+        " (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)"
+    )
+    conn.commit()
+    return conn
+
+
+def _fetch_embedding(conn, key: str, text: str) -> tuple[float, ...]:
+    row = conn.execute(
+        "SELECT embedding FROM embeddings WHERE key = ?", (key,)
+    ).fetchone()
+    if row:
+        return tuple(orjson.loads(row[0]))
+
+    # Use Gemini's embedding model
+    result = genai.embed_content(model=EMBED_MODEL, content=text)
+    embedding = result["embedding"]
+    conn.execute(
+        "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+        (key, orjson.dumps(embedding)),
+    )
+    conn.commit()
+    return tuple(embedding)
+
+
+@st.cache_resource
+def _embedding_lru():
+    # In-memory LRU in front of the sqlite layer. Held as a resource so it
+    # survives reruns and, unlike st.cache_data, can be called off the script
+    # thread.
+    return functools.lru_cache(maxsize=2048)(_fetch_embedding)
+
+
+@st.cache_resource
+def _embedding_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="embed")
+
+
+def start_embedding(text: str) -> Future:
+    """Fetch the embedding on a worker thread so it overlaps other work."""
+    return _embedding_executor().submit(
+        _embedding_lru(), get_embed_cache(), _cache_key(text), text
+    )
+
+
+def get_embedding(future: Future):
     try:
-        # Use Gemini's embedding model
-        result = genai.embed_content(model="models/text-embedding-004", content=text)
-        return result["embedding"]
+        return future.result()
     except Exception as e:
         st.error(f"Embedding Error: {e}")
         return None
 
 
-# Sidebar: Model Selection
-st.sidebar.header("Settings")
-try:
+@st.cache_resource(ttl=3600)
+def _list_gen_models():
     # Get models that support content generation
-    available_models = [
+    return [
         m.name
         for m in genai.list_models()
         if "generateContent" in m.supported_generation_methods
     ]
 
+
+# Chat Input: st.chat_input pins to the bottom of the page wherever it is
+# called, so read it first and start the embedding round-trip now; it runs
+# while the models are listed and the sidebar and history are drawn.
+placeholder = "e.g., Top 5 customers who rented the most horror movies."
+user_question = st.chat_input(placeholder)
+embedding_future = start_embedding(user_question) if user_question else None
+
+# Sidebar: Model Selection
+st.sidebar.header("Settings")
+try:
+    available_models = _list_gen_models()
+
     # Determine default index (prefer 1.5-flash, then pro)
     default_model = "models/gemini-1.5-flash"
     if default_model in available_models:
@@ -191,27 +544,67 @@ def load_metadata():
     return ""
 
 
+@st.cache_data
+def build_system_instruction(metadata_text: str, schema_text: str) -> str:
+    return f"""
+    You are a helpful database analyst assistant.
+    Your goal is to answer the user's question by querying the
+    database.
+
+    Database Schema (table(column type, ...)):
+    {schema_text}
+
+    Database Metadata:
+    {metadata_text}
+
+    Follow this strict process:
+    1. Review the Database Schema and Metadata to understand the schema.
+    2. Take column names from the Database Schema above. Call
+       `get_table_schema` only for tables that are not listed there.
+    3. Construct a valid PostgreSQL query based on the schema.
+       - Always cast dates to 'YYYY-MM-DD' format if
+         comparing strings.
+       - Use ILIKE for case-insensitive text matching.
+    4. Call `execute_sql` to run the query.
+    5. Analyze the results and provide a clear, natural
+       language answer to the user.
+    """
+
+
+# Bound once per run; reused by the sidebar and the agent below
+metadata_text = load_metadata()
+
 if st.sidebar.checkbox("Show Metadata"):
-    st.sidebar.text(load_metadata())
+    st.sidebar.text(metadata_text)
 
 # Sidebar: Usage Metrics
-st.sidebar.markdown("---")
-st.sidebar.header("Session Usage")
-cols = st.sidebar.columns(2)
-cols[0].metric("Input Tokens", st.session_state.token_metrics["input"])
-cols[1].metric("Output Tokens", st.session_state.token_metrics["output"])
-st.sidebar.metric(
-    "Est. Cost ($)", f"{st.session_state.token_metrics['total_cost']:.6f}"
-)
+# Drawn into a placeholder so a finished turn can refresh just this block
+# instead of rerunning the whole script.
+usage_slot = st.sidebar.empty()
+
+
+def _usage_sidebar():
+    with usage_slot.container():
+        st.markdown("---")
+        st.header("Session Usage")
+        cols = st.columns(2)
+        cols[0].metric("Input Tokens", st.session_state.token_metrics["input"])
+        cols[1].metric("Output Tokens", st.session_state.token_metrics["output"])
+        st.metric(
+            "Est. Cost ($)", f"{st.session_state.token_metrics['total_cost']:.6f}"
+        )
+
+        st.markdown("---")
+        st.header("Total History Usage")
+        cols_g = st.columns(2)
+        cols_g[0].metric("Total Input", st.session_state.global_metrics["input"])
+        cols_g[1].metric("Total Output", st.session_state.global_metrics["output"])
+        st.metric(
+            "Total Cost ($)", f"{st.session_state.global_metrics['total_cost']:.6f}"
+        )
 
-st.sidebar.markdown("---")
-st.sidebar.header("Total History Usage")
-cols_g = st.sidebar.columns(2)
-cols_g[0].metric("Total Input", st.session_state.global_metrics["input"])
-cols_g[1].metric("Total Output", st.session_state.global_metrics["output"])
-st.sidebar.metric(
-    "Total Cost ($)", f"{st.session_state.global_metrics['total_cost']:.6f}"
-)
+
+_usage_sidebar()
 
 
 # 3. Define Tools for Gemini (The "Hands")
@@ -220,8 +613,12 @@ def list_tables():
     Retrieves a list of all table names in the database.
     Use this first to understand what data is available.
     """
+    snapshot = st.session_state.get("schema_snapshot")
+    if snapshot:
+        return snapshot["tables"]
+
     req = {"id": "list_tables", "method": "list_tables", "params": {}}
-    resp = _send_request(st.session_state.mcp_proc, req)
+    resp = _call_server(req)
     if resp and "result" in resp:
         return resp["result"].get("tables", [])
     return []
@@ -232,17 +629,34 @@ def get_table_schema(table_names: list[str]):
     Retrieves the schema (columns and data types) for a specific list of tables.
     Use this to understand column names before writing a SQL query.
     """
+    snapshot = st.session_state.get("schema_snapshot")
+    if snapshot and all(t in snapshot["columns"] for t in table_names):
+        return [row for t in table_names for row in snapshot["columns"][t]]
+
+    # Views and other tables outside the snapshot: memoize per set of tables
+    schema_cache = st.session_state.setdefault("_schema_cache", {})
+    cache_key = frozenset(table_names)
+    if cache_key in schema_cache:
+        return schema_cache[cache_key]
+
     req = {
         "id": "get_schema",
         "method": "get_table_schema",
         "params": {"table_names": table_names},
     }
-    resp = _send_request(st.session_state.mcp_proc, req)
+    resp = _call_server(req)
     if resp and "result" in resp:
-        return resp["result"].get("schema_rows", [])
+        schema_rows = resp["result"].get("schema_rows", [])
+        if schema_rows:
+            schema_cache[cache_key] = schema_rows
+        return schema_rows
     return []
 
 
+# Rows kept inline in chat history per result; the rest load on demand
+HISTORY_PREVIEW_ROWS = 500
+
+
 def execute_sql(query: str):
     """
     Executes a SQL query against the database and returns the results.
@@ -252,7 +666,7 @@ def execute_sql(query: str):
     st.code(query, language="sql")
 
     req = {"id": "exec_sql", "method": "run_pagila_query", "params": {"query": query}}
-    resp = _send_request(st.session_state.mcp_proc, req)
+    resp = _call_server(req)
 
     if not resp:
         st.error("MCP Server did not respond.")
@@ -265,42 +679,84 @@ def execute_sql(query: str):
         return f"Error: {resp['error']}"
 
     st.session_state.last_execution_success = True
-    rows = resp.get("result", {}).get("rows", [])
+    # Columnar payload: {"columns": [...], "rows": [[...], ...]}
+    result = resp.get("result", {})
+    # Build the frame once; reruns replay it instead of re-converting rows
+    df = pd.DataFrame(result.get("rows", []), columns=result.get("columns"))
 
     st.markdown("### Query Results")
-    st.dataframe(rows)
+    st.dataframe(df)
+
+    # Persist to history so it remains after rerun. Large results keep a
+    # preview there and the full frame under its own key, shown on demand.
+    entry = {
+        "role": "assistant",
+        "type": "sql_result",
+        "sql": query,
+        "df": df.head(HISTORY_PREVIEW_ROWS),
+    }
+    if len(df) > HISTORY_PREVIEW_ROWS:
+        result_key = f"result_{len(st.session_state.chat_history)}"
+        st.session_state[result_key] = df
+        entry["result_key"] = result_key
+    st.session_state.chat_history.append(entry)
+
+    return result
+
+
+# Upper bound on model <-> tool round-trips within a single user turn
+MAX_TOOL_ROUNDS = 10
 
-    # Persist to history so it remains after rerun
-    st.session_state.chat_history.append(
-        {"role": "assistant", "type": "sql_result", "sql": query, "rows": rows}
-    )
 
-    return rows
+def _stream_text(response, function_calls: list):
+    """Yield text parts as they stream in and collect requested tool calls."""
+    for chunk in response:
+        if not chunk.candidates:
+            continue
+        for part in chunk.parts:
+            if "function_call" in part:
+                function_calls.append(part.function_call)
+                st.caption(f"Calling `{part.function_call.name}`…")
+            elif part.text:
+                yield part.text
+
+
+def _run_tool(tool_functions: dict, fc):
+    """Run one requested tool and wrap its result as a function response part."""
+    fn = tool_functions.get(fc.name)
+    if fn is None:
+        result = {"error": f"Unknown tool: {fc.name}"}
+    else:
+        result = fn(**fc.args)
+        if not isinstance(result, dict):
+            result = {"result": result}
+    return genai.protos.Part(
+        function_response=genai.protos.FunctionResponse(name=fc.name, response=result)
+    )
 
 
 # 4. Streamlit UI Layout
 col_title, col_metric = st.columns([4, 1])
 with col_title:
     st.title("🎬 Pagila Database AI Assistant")
-with col_metric:
-    if "sql_collection" in st.session_state:
-        st.metric("Cached Prompts", st.session_state.sql_collection.count())
+cached_prompts_slot = col_metric.empty()
+cached_prompts_slot.metric("Cached Prompts", len(get_sql_cache()["entries"]))
 
 st.markdown("Ask questions about the movie rental database in plain English.")
 
 with st.expander("📂 View Vector Cache Content"):
-    if "sql_collection" in st.session_state:
-        cache_data = st.session_state.sql_collection.get()
-        if cache_data and cache_data.get("ids"):
-            # Prepare data for display
-            display_rows = []
-            for i, doc in enumerate(cache_data["documents"]):
-                meta = cache_data["metadatas"][i] if cache_data["metadatas"] else {}
-                row = {"Question": doc, "SQL": meta.get("sql", "")}
-                display_rows.append(row)
-            st.dataframe(display_rows, use_container_width=True)
-        else:
-            st.info("Vector cache is empty.")
+    cache_entries = get_sql_cache()["entries"]
+    if cache_entries:
+        # Every entry is written with both keys, so map itemgetters column-wise
+        df = pd.DataFrame(
+            {
+                "Question": list(map(itemgetter("question"), cache_entries)),
+                "SQL": list(map(itemgetter("sql"), cache_entries)),
+            }
+        )
+        st.dataframe(df, use_container_width=True)
+    else:
+        st.info("Vector cache is empty.")
 
 # Display Chat History
 for msg in st.session_state.chat_history:
@@ -309,13 +765,19 @@ for msg in st.session_state.chat_history:
             st.markdown("### Generated SQL")
             st.code(msg["sql"], language="sql")
             st.markdown("### Query Results")
-            st.dataframe(msg["rows"])
+            st.dataframe(msg["df"])
+            result_key = msg.get("result_key")
+            if result_key and result_key in st.session_state:
+                full_df = st.session_state[result_key]
+                if st.checkbox(
+                    f"Show all {len(full_df)} rows", key=f"show_{result_key}"
+                ):
+                    st.dataframe(full_df)
         else:
             st.markdown(msg["content"])
 
-# Chat Input
-placeholder = "e.g., Top 5 customers who rented the most horror movies."
-if user_question := st.chat_input(placeholder):
+# Handle the question read at the top; its embedding is already in flight
+if user_question:
     # 1. Display User Message
     with st.chat_message("user"):
         st.markdown(user_question)
@@ -331,16 +793,11 @@ if user_question := st.chat_input(placeholder):
 
         # --- Step 1: Check Vector Cache ---
         cached_sql = None
-        embedding = get_embedding(user_question)
+        embedding = get_embedding(embedding_future)
 
         if embedding:
             try:
-                results = st.session_state.sql_collection.query(
-                    query_embeddings=[embedding], n_results=1
-                )
-                # Distance threshold (lower is better). 0.2 is very strict to prevent false positives
-                if results["documents"] and results["distances"][0][0] < 0.2:
-                    cached_sql = results["metadatas"][0][0]["sql"]
+                cached_sql = sql_cache_lookup(embedding)
             except Exception:
                 pass  # Cache miss or error, proceed to agent
 
@@ -363,48 +820,63 @@ if user_question := st.chat_input(placeholder):
                     # 5. Configure the Agent with Tools
                     tools = [list_tables, get_table_schema, execute_sql]
 
-                    # Load metadata
-                    metadata_text = load_metadata()
-
-                    system_instruction = f"""
-                    You are a helpful database analyst assistant.
-                    Your goal is to answer the user's question by querying the
-                    database.
-
-                    Database Metadata:
-                    {metadata_text}
-
-                    Follow this strict process:
-                    1. Review the Database Metadata to understand the schema.
-                    2. Call `get_table_schema` for the specific tables
-                       relevant to the question to verify column names.
-                    3. Construct a valid PostgreSQL query based on the schema
-                       you retrieved.
-                       - Always cast dates to 'YYYY-MM-DD' format if
-                         comparing strings.
-                       - Use ILIKE for case-insensitive text matching.
-                    4. Call `execute_sql` to run the query.
-                    5. Analyze the results and provide a clear, natural
-                       language answer to the user.
-                    """
-
-                    model = genai.GenerativeModel(
-                        selected_model,
-                        tools=tools,
-                        system_instruction=system_instruction,
+                    snapshot = get_schema_snapshot()
+                    system_instruction = build_system_instruction(
+                        metadata_text, snapshot["text"] if snapshot else ""
                     )
 
-                    # Start a chat session with automatic function calling enabled
-                    chat = model.start_chat(enable_automatic_function_calling=True)
-
-                    # Send message
-                    response = chat.send_message(user_question)
+                    # Reuse the model until the model choice or prompt changes
+                    model_key = (selected_model, _cache_key(system_instruction))
+                    cached_model = st.session_state.get("_genai_model")
+                    if cached_model and cached_model[0] == model_key:
+                        model = cached_model[1]
+                    else:
+                        model = genai.GenerativeModel(
+                            selected_model,
+                            tools=tools,
+                            system_instruction=system_instruction,
+                        )
+                        st.session_state["_genai_model"] = (model_key, model)
+
+                    # The SDK can't stream with automatic function calling, so
+                    # stream each round and run the requested tools ourselves.
+                    tool_functions = {fn.__name__: fn for fn in tools}
+                    chat = model.start_chat()
+
+                    in_tokens = out_tokens = 0
+                    text_parts: list[str] = []
+                    content = user_question
+                    for _ in range(MAX_TOOL_ROUNDS):
+                        function_calls: list = []
+                        response = chat.send_message(content, stream=True)
+                        streamed = message_placeholder.write_stream(
+                            _stream_text(response, function_calls)
+                        )
+                        if isinstance(streamed, str) and streamed:
+                            text_parts.append(streamed)
+
+                        # Available once the stream has been fully consumed
+                        if response.usage_metadata:
+                            usage = response.usage_metadata
+                            in_tokens += usage.prompt_token_count
+                            out_tokens += usage.candidates_token_count
+
+                        if not function_calls:
+                            break
+                        content = genai.protos.Content(
+                            parts=[
+                                _run_tool(tool_functions, fc) for fc in function_calls
+                            ]
+                        )
+                    else:
+                        # Out of rounds with tool calls still pending
+                        text_parts.append(
+                            f"_Stopped after {MAX_TOOL_ROUNDS} tool rounds without"
+                            " a final answer. Try rephrasing the question._"
+                        )
 
                     # Calculate Usage & Cost
-                    if response.usage_metadata:
-                        in_tokens = response.usage_metadata.prompt_token_count
-                        out_tokens = response.usage_metadata.candidates_token_count
-
+                    if in_tokens or out_tokens:
                         st.session_state.token_metrics["input"] += in_tokens
                         st.session_state.token_metrics["output"] += out_tokens
 
@@ -418,10 +890,11 @@ if user_question := st.chat_input(placeholder):
                         st.session_state.global_metrics["input"] += in_tokens
                         st.session_state.global_metrics["output"] += out_tokens
                         st.session_state.global_metrics["total_cost"] += cost
-                        save_global_stats(st.session_state.global_metrics)
+                        _mark_dirty(st.session_state.global_metrics)
 
                     # 6. Display Final Answer & Update History
-                    final_text = response.text
+                    # Each round streams its own text; keep them as paragraphs
+                    final_text = "\n\n".join(text_parts)
                     message_placeholder.markdown(final_text)
                     st.session_state.chat_history.append(
                         {"role": "assistant", "content": final_text}
@@ -433,20 +906,18 @@ if user_question := st.chat_input(placeholder):
                         and st.session_state.last_execution_success
                         and embedding
                     ):
-                        st.session_state.sql_collection.add(
-                            ids=[hashlib.md5(user_question.encode()).hexdigest()],
-                            embeddings=[embedding],
-                            metadatas=[
-                                {
-                                    "sql": st.session_state.last_executed_sql,
-                                    "question": user_question,
-                                }
-                            ],
-                            documents=[user_question],
+                        sql_cache_add(
+                            _cache_key(user_question),
+                            user_question,
+                            st.session_state.last_executed_sql,
+                            embedding,
                         )
 
-                    # Force rerun to update sidebar metrics immediately
-                    st.rerun()
+                    # Refresh the metrics in place rather than rerunning the script
+                    _usage_sidebar()
+                    cached_prompts_slot.metric(
+                        "Cached Prompts", len(get_sql_cache()["entries"])
+                    )
 
                 except Exception as e:
                     st.error(f"An error occurred: {str(e)}")
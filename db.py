@@ -1,16 +1,27 @@
+# Single source of truth for DB access. Note on psycopg 3: when execute() gets a
+# params sequence (even an empty one) it parses %-placeholders in the query, so
+# literal percent signs such as ILIKE '%love%' break. run_query therefore binds
+# None whenever no params are given.
+import atexit
 import logging
 import os
+import threading
 import time
 from contextlib import contextmanager
-from typing import Any, Iterable
+from typing import Any, Iterable, Iterator, Optional
 
 from dotenv import load_dotenv
-from psycopg import DatabaseError, OperationalError, connect
-from psycopg.rows import dict_row
+from psycopg import Connection, DatabaseError, OperationalError
+from psycopg.rows import RowFactory, tuple_row
+from psycopg_pool import ConnectionPool
 
 logger = logging.getLogger(__name__)
 load_dotenv("config.env")
 
+# Shared pool, created on first use so importing this module stays cheap.
+_POOL: Optional[ConnectionPool] = None
+_POOL_LOCK = threading.Lock()
+
 
 def get_db_params() -> dict[str, Any]:
     return {
@@ -22,51 +33,149 @@ def get_db_params() -> dict[str, Any]:
     }
 
 
+def _reset_session(conn: Connection) -> None:
+    """Undo session state a query left behind before the pool reuses conn.
+
+    Raw SELECTs can call set_config() or take advisory locks; without this a
+    later request would inherit e.g. another search_path or statement_timeout.
+    RESET ALL keeps server-side prepared statements, unlike DISCARD ALL.
+    """
+    conn.execute("RESET ALL", prepare=False)
+    conn.execute("SELECT pg_advisory_unlock_all()", prepare=False)
+    conn.commit()
+
+
+def get_pool() -> ConnectionPool:
+    global _POOL
+    if _POOL is not None:
+        return _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            params = get_db_params()
+            logger.debug(
+                "Opening DB connection pool to %s:%s/%s",
+                params["host"],
+                params["port"],
+                params["dbname"],
+            )
+            _POOL = ConnectionPool(
+                conninfo="",
+                kwargs={**params, "prepare_threshold": 1},
+                min_size=2,
+                max_size=10,
+                timeout=float(os.getenv("PG_POOL_TIMEOUT", "10")),
+                reset=_reset_session,
+                open=True,
+            )
+            atexit.register(_POOL.close)
+    return _POOL
+
+
 @contextmanager
 def get_connection():
-    params = get_db_params()
     try:
-        logger.debug(
-            "Opening DB connection to %s:%s/%s",
-            params["host"],
-            params["port"],
-            params["dbname"],
-        )
-        conn = connect(**params)
-        yield conn
+        with get_pool().connection() as conn:
+            yield conn
     except OperationalError as exc:
         logger.error("DB connection failed: %s", exc, exc_info=True)
         raise
-    finally:
-        try:
-            conn.close()  # type: ignore[name-defined]
-            logger.debug("DB connection closed")
-        except Exception:
-            pass
 
 
-def run_query(query: str, params: Iterable[Any] | None = None):
+def unique_columns(names: Iterable[str]) -> list[str]:
+    """Suffix repeated column names so each is unique (``id``, ``id_1``, ...).
+
+    Joins such as ``SELECT *`` repeat names like ``film_id``; DataFrames and
+    ``st.dataframe`` reject duplicate columns.
+    """
+    used: set[str] = set()
+    counts: dict[str, int] = {}
+    out = []
+    for name in names:
+        new = name
+        while new in used:
+            counts[name] = counts.get(name, 0) + 1
+            new = f"{name}_{counts[name]}"
+        used.add(new)
+        out.append(new)
+    return out
+
+
+def _execute(
+    query: str,
+    params: Iterable[Any] | None,
+    prepare: Optional[bool],
+    row_factory: RowFactory,
+) -> tuple[list[str], list[Any]]:
     with get_connection() as conn:
         try:
-            with conn.cursor(row_factory=dict_row) as cur:
+            with conn.cursor(row_factory=row_factory) as cur:
                 logger.debug("Executing query: %s params=%s", query, params)
                 start = time.monotonic()
                 # psycopg's execute treats percent-signs in the query as
                 # placeholders when a params sequence is provided. If no
-                # params are given, call execute(query) to avoid parsing
-                # literal %% patterns (for example in ILIKE '%love%').
-                if params:
-                    cur.execute(query, tuple(params))
-                else:
-                    cur.execute(query)
+                # params are given, pass None to avoid parsing literal %%
+                # patterns (for example in ILIKE '%love%').
+                # prepare=True forces a server-side prepared statement for
+                # hot queries; None leaves it to the pool's prepare_threshold.
+                cur.execute(query, tuple(params) if params else None, prepare=prepare)
                 rows = cur.fetchall()
+                columns = unique_columns(c.name for c in cur.description or ())
                 duration = time.monotonic() - start
                 logger.info(
                     "Query executed rows=%d duration=%.3fs",
                     len(rows) if isinstance(rows, list) else -1,
                     duration,
                 )
-                return rows
+                return columns, rows
         except DatabaseError as exc:
             logger.error("Error executing query: %s", exc, exc_info=True)
             raise
+
+
+def run_query(
+    query: str,
+    params: Iterable[Any] | None = None,
+    prepare: Optional[bool] = None,
+    row_factory: RowFactory = tuple_row,
+):
+    """Run a query and return its rows (plain tuples unless told otherwise).
+
+    Pass ``row_factory=dict_row`` where callers genuinely need mappings.
+    """
+    return _execute(query, params, prepare, row_factory)[1]
+
+
+def run_query_columns(
+    query: str,
+    params: Iterable[Any] | None = None,
+    prepare: Optional[bool] = None,
+) -> tuple[list[str], list[tuple]]:
+    """Run a query and return ``(column names, tuple rows)``.
+
+    Used for JSON-bound results so each row doesn't repeat its column names.
+    """
+    return _execute(query, params, prepare, tuple_row)
+
+
+@contextmanager
+def stream_query(
+    query: str,
+    params: Iterable[Any] | None = None,
+    itersize: int = 1000,
+) -> Iterator[tuple[list[str], Iterator[tuple]]]:
+    """Yield ``(column names, row iterator)`` backed by a server-side cursor.
+
+    Rows are pulled from PostgreSQL ``itersize`` at a time instead of being
+    materialized with fetchall(); the pooled connection is held until the
+    with-block exits.
+    """
+    with get_connection() as conn:
+        try:
+            with conn.cursor(name="pagila_stream", row_factory=tuple_row) as cur:
+                cur.itersize = itersize
+                logger.debug("Streaming query: %s params=%s", query, params)
+                cur.execute(query, tuple(params) if params else None)
+                yield unique_columns(c.name for c in cur.description or ()), iter(cur)
+        except DatabaseError as exc:
+            logger.error("Error streaming query: %s", exc, exc_info=True)
+            raise
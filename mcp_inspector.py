@@ -20,13 +20,17 @@ Usage examples:
 from __future__ import annotations
 
 import argparse
-import json
 import os
+import selectors
 import subprocess
 import sys
-import threading
 from typing import Optional
 
+import orjson
+
+# orjson writes bytes directly, so the server pipes are opened in binary mode.
+ORJSON_OPTS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC
+
 
 def start_server(python_executable: str = None) -> subprocess.Popen:
     # Prefer workspace virtualenv python if present
@@ -43,40 +47,113 @@ def start_server(python_executable: str = None) -> subprocess.Popen:
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        text=True,
-        bufsize=1,
+        text=False,
     )
 
-    # thread to forward stderr from server to our stderr with a prefix
-    def _stderr_reader():
-        assert proc.stderr is not None
-        for line in proc.stderr:
-            sys.stderr.write("[server-stderr] " + line)
-
-    t = threading.Thread(target=_stderr_reader, daemon=True)
-    t.start()
+    # no reader thread: server stderr is drained while each request runs
+    assert proc.stderr is not None
+    os.set_blocking(proc.stderr.fileno(), False)
     return proc
 
 
+# server stderr is forwarded in bulk, one write and flush per drain
+STDERR_PREFIX = b"[server-stderr] "
+
+
+def drain_stderr(proc: subprocess.Popen) -> bool:
+    """Forward whatever the server has written to stderr, without blocking.
+
+    Returns False once stderr has reached EOF.
+    """
+    assert proc.stderr is not None
+    buf = bytearray()
+    open_ = True
+    while True:
+        try:
+            chunk = os.read(proc.stderr.fileno(), 65536)
+        except BlockingIOError:
+            break
+        if not chunk:
+            open_ = False
+            break
+        buf += chunk
+    if buf:
+        out = sys.stderr.buffer
+        out.write(b"".join(STDERR_PREFIX + ln for ln in buf.splitlines(keepends=True)))
+        out.flush()
+    return open_
+
+
+class ResponseReader:
+    """Read response lines from the server's stdout, forwarding its stderr.
+
+    A plain stdout.readline() deadlocks once the server fills the stderr pipe
+    (~64 KiB, e.g. with LOG_LEVEL=DEBUG) before answering, so both pipes are
+    polled together. Used for one request at a time: the server writes
+    nothing to stdout unprompted, so no bytes are left over between requests.
+    """
+
+    def __init__(self, proc: subprocess.Popen):
+        assert proc.stdout is not None and proc.stderr is not None
+        self.proc = proc
+        self._buf = bytearray()
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(proc.stdout, selectors.EVENT_READ)
+        self._sel.register(proc.stderr, selectors.EVENT_READ)
+
+    def readline(self) -> bytes:
+        stdout = self.proc.stdout
+        while True:
+            end = self._buf.find(b"\n") + 1
+            if end:
+                line = bytes(self._buf[:end])
+                del self._buf[:end]
+                return line
+            for key, _ in self._sel.select():
+                if key.fileobj is stdout:
+                    chunk = os.read(stdout.fileno(), 65536)
+                    if not chunk:
+                        # EOF: hand back any partial line (b"" if none)
+                        line = bytes(self._buf)
+                        self._buf.clear()
+                        return line
+                    self._buf += chunk
+                elif not drain_stderr(self.proc):
+                    self._sel.unregister(self.proc.stderr)
+
+    def close(self) -> None:
+        self._sel.close()
+
+
 def send_request(proc: subprocess.Popen, request: dict) -> Optional[dict]:
     assert proc.stdin is not None and proc.stdout is not None
-    line = json.dumps(request, default=str) + "\n"
+    line = orjson.dumps(request, default=str, option=ORJSON_OPTS) + b"\n"
+    drain_stderr(proc)
     proc.stdin.write(line)
     proc.stdin.flush()
 
     # read one line response
-    resp_line = proc.stdout.readline()
+    reader = ResponseReader(proc)
+    try:
+        resp_line = reader.readline()
+    finally:
+        reader.close()
+    drain_stderr(proc)
     if not resp_line:
         return None
     try:
-        return json.loads(resp_line)
+        return orjson.loads(resp_line)
     except Exception:
-        print("Failed to parse server response:\n", resp_line)
+        print("Failed to parse server response:\n", resp_line.decode(errors="replace"))
         return None
 
 
 def pretty_print(obj: object) -> None:
-    print(json.dumps(obj, indent=2, default=str))
+    print(
+        orjson.dumps(
+            obj, default=str, option=ORJSON_OPTS | orjson.OPT_INDENT_2
+        ).decode()
+    )
 
 
 def repl(proc: subprocess.Popen) -> None:
@@ -131,7 +208,7 @@ def repl(proc: subprocess.Popen) -> None:
                 parse_attempts.append(js[1:-1])
             for candidate in parse_attempts:
                 try:
-                    req = json.loads(candidate)
+                    req = orjson.loads(candidate)
                     break
                 except Exception:
                     continue
@@ -173,7 +250,7 @@ def main() -> int:
                     parse_attempts.append(js[1:-1])
                 for candidate in parse_attempts:
                     try:
-                        req = json.loads(candidate)
+                        req = orjson.loads(candidate)
                         break
                     except Exception:
                         continue
@@ -1,55 +1,72 @@
+import argparse
 import asyncio
-import json
+import base64
 import logging
 import os
 import re
+import struct
 import sys
 import time
 from decimal import Decimal
+from itertools import islice
 from logging.handlers import RotatingFileHandler
-from typing import Any, Dict
+from typing import Any, BinaryIO, Dict, Optional
 
+import msgspec
+import orjson
+import pyarrow as pa
 from dotenv import load_dotenv
+from psycopg.rows import dict_row
 
-from db import run_query
+from db import run_query, run_query_columns, stream_query
 
 load_dotenv("config.env", override=True)
 
-# Configure logging: stream to stderr + rotating file handler in logs/
-LOG_DIR = os.getenv("LOG_DIR", "logs")
-os.makedirs(LOG_DIR, exist_ok=True)
-log_file = os.path.join(LOG_DIR, "pagila.log")
-log_level_name = os.getenv("LOG_LEVEL", "INFO").upper()
-log_level = getattr(logging, log_level_name, logging.INFO)
-
-# Root logger config: ensure both stderr and file handlers
-root_logger = logging.getLogger()
-root_logger.setLevel(log_level)
-formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s - %(message)s")
-
-# Stream handler -> stderr
-sh = logging.StreamHandler(sys.stderr)
-sh.setFormatter(formatter)
-
-# Rotating file handler (5 MB per file, keep 5 backups)
-fh = RotatingFileHandler(
-    log_file, maxBytes=5 * 1024 * 1024, backupCount=5, encoding="utf-8"
-)
-fh.setFormatter(formatter)
 
-# Replace existing handlers to avoid duplicated logs when reloading
-if root_logger.handlers:
-    root_logger.handlers.clear()
-root_logger.addHandler(sh)
-root_logger.addHandler(fh)
+def configure_logging() -> None:
+    """Stream logs to stderr and to a rotating file handler in LOG_DIR.
+
+    Only called from `main()` so that importing this module in-process (e.g.
+    from `app.py`) does not replace the host application's logging setup.
+    """
+    log_dir = os.getenv("LOG_DIR", "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, "pagila.log")
+    log_level_name = os.getenv("LOG_LEVEL", "INFO").upper()
+    log_level = getattr(logging, log_level_name, logging.INFO)
+
+    # Root logger config: ensure both stderr and file handlers
+    root_logger = logging.getLogger()
+    root_logger.setLevel(log_level)
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s - %(message)s")
+
+    # Stream handler -> stderr
+    sh = logging.StreamHandler(sys.stderr)
+    sh.setFormatter(formatter)
+
+    # Rotating file handler (5 MB per file, keep 5 backups)
+    fh = RotatingFileHandler(
+        log_file, maxBytes=5 * 1024 * 1024, backupCount=5, encoding="utf-8"
+    )
+    fh.setFormatter(formatter)
+
+    # Replace existing handlers to avoid duplicated logs when reloading
+    if root_logger.handlers:
+        root_logger.handlers.clear()
+    root_logger.addHandler(sh)
+    root_logger.addHandler(fh)
+
 
 logger = logging.getLogger(__name__)
 
 
 # JSON default serializer for non-JSON types (Decimal etc.)
-def _json_default(o):
+def json_default(o):
     if isinstance(o, Decimal):
         return float(o)
+    if isinstance(o, bytes):
+        # e.g. Arrow IPC payloads on the JSON-lines framing
+        return base64.b64encode(o).decode("ascii")
     return str(o)
 
 
@@ -63,7 +80,7 @@ async def handle_list_films(params: Dict[str, Any]) -> Dict[str, Any]:
     """
     # run blocking DB call off the event loop
     start = time.monotonic()
-    rows = await asyncio.to_thread(run_query, sql, (limit,))
+    columns, rows = await asyncio.to_thread(run_query_columns, sql, (limit,))
     duration = time.monotonic() - start
     logger.debug(
         "handle_list_films finished limit=%s rows=%d duration=%.3fs",
@@ -71,10 +88,10 @@ async def handle_list_films(params: Dict[str, Any]) -> Dict[str, Any]:
         len(rows) if isinstance(rows, list) else -1,
         duration,
     )
-    return {"rows": rows}
+    return {"columns": columns, "rows": rows}
 
 
-async def handle_list_tables(params: Dict[str, Any]) -> Dict[str, Any]:
+def list_tables_impl() -> Dict[str, Any]:
     """List all public tables in the database."""
     sql = """
         SELECT table_name
@@ -83,32 +100,40 @@ async def handle_list_tables(params: Dict[str, Any]) -> Dict[str, Any]:
         AND table_type = 'BASE TABLE'
         ORDER BY table_name
     """
-    rows = await asyncio.to_thread(run_query, sql, None)
-    return {"tables": [r["table_name"] for r in rows]}
+    rows = run_query(sql, None, prepare=True)
+    return {"tables": [name for (name,) in rows]}
 
 
-async def handle_get_table_schema(params: Dict[str, Any]) -> Dict[str, Any]:
+def get_table_schema_impl(table_names: Any) -> Dict[str, Any]:
     """Get column definitions for a specific list of tables."""
-    table_names = params.get("table_names", [])
     if isinstance(table_names, str):
         table_names = [table_names]
 
     if not table_names:
         return {"schema": "No tables specified."}
 
-    # Parameterized IN clause
-    placeholders = ",".join(["%s"] * len(table_names))
-    sql = f"""
-        SELECT table_name, column_name, data_type
+    # Single round-trip for every table: the list is bound as one array param
+    sql = """
+        SELECT table_name, column_name, data_type, ordinal_position
         FROM information_schema.columns
         WHERE table_schema = 'public'
-        AND table_name IN ({placeholders})
+        AND table_name = ANY(%s)
         ORDER BY table_name, ordinal_position
     """
-    rows = await asyncio.to_thread(run_query, sql, tuple(table_names))
+    rows = run_query(sql, (list(table_names),), prepare=True, row_factory=dict_row)
     return {"schema_rows": rows}
 
 
+async def handle_list_tables(params: Dict[str, Any]) -> Dict[str, Any]:
+    """List all public tables in the database."""
+    return await asyncio.to_thread(list_tables_impl)
+
+
+async def handle_get_table_schema(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Get column definitions for a specific list of tables."""
+    return await asyncio.to_thread(get_table_schema_impl, params.get("table_names", []))
+
+
 async def _get_schema_info() -> Dict[str, list]:
     """Return a mapping table_name -> list of column names from information_schema."""
     sql = """
@@ -117,11 +142,9 @@ async def _get_schema_info() -> Dict[str, list]:
         WHERE table_schema = 'public'
         ORDER BY table_name, ordinal_position
     """
-    rows = await asyncio.to_thread(run_query, sql, None)
+    rows = await asyncio.to_thread(run_query, sql, None, prepare=True)
     schema: Dict[str, list] = {}
-    for r in rows:
-        t = r.get("table_name")
-        c = r.get("column_name")
+    for t, c in rows:
         schema.setdefault(t, []).append(c)
     return schema
 
@@ -261,10 +284,11 @@ async def handle_text_to_sql(params: Dict[str, Any]) -> Dict[str, Any]:
     if execute:
         start = time.monotonic()
         # pass params to run_query so the driver can handle escaping
-        rows = await asyncio.to_thread(
-            run_query, sql, params_for_sql if params_for_sql else None
+        columns, rows = await asyncio.to_thread(
+            run_query_columns, sql, params_for_sql if params_for_sql else None
         )
         duration = time.monotonic() - start
+        result["columns"] = columns
         result["rows"] = rows
         result["duration"] = duration
 
@@ -276,8 +300,8 @@ async def handle_text_to_sql(params: Dict[str, Any]) -> Dict[str, Any]:
     return result
 
 
-async def handle_run_pagila_query(params: Dict[str, Any]) -> Dict[str, Any]:
-    query = params.get("query", "")
+def _check_raw_query(query: Any) -> str:
+    """Validate a raw read-only SELECT and return it without a trailing ';'."""
     if not isinstance(query, str):
         raise ValueError("Query must be a string")
 
@@ -301,15 +325,24 @@ async def handle_run_pagila_query(params: Dict[str, Any]) -> Dict[str, Any]:
         if bad in qnorm:
             raise ValueError("Query contains disallowed patterns")
 
-    # execute safely (no params since this is a raw SQL path)
-    # then cap rows to avoid huge responses
+    # server-side cursors wrap the query in DECLARE, which rejects a ';'
+    return qstr.rstrip(";")
+
+
+def run_pagila_query_impl(query: str) -> Dict[str, Any]:
+    """Validate and run a raw read-only SELECT, capping the returned rows."""
+    query = _check_raw_query(query)
+
+    # execute safely (no params since this is a raw SQL path), streaming
+    # from a server-side cursor so only MAX_ROWS + 1 rows are ever fetched
+    MAX_ROWS = int(os.getenv("MCP_MAX_ROWS", "1000"))
     start = time.monotonic()
-    rows = await asyncio.to_thread(run_query, query, None)
+    with stream_query(query) as (columns, row_iter):
+        rows = list(islice(row_iter, MAX_ROWS + 1))
     duration = time.monotonic() - start
 
-    MAX_ROWS = int(os.getenv("MCP_MAX_ROWS", "1000"))
     note = None
-    if isinstance(rows, list) and len(rows) > MAX_ROWS:
+    if len(rows) > MAX_ROWS:
         note = f"Truncated results to first {MAX_ROWS} rows"
         rows = rows[:MAX_ROWS]
 
@@ -319,17 +352,102 @@ async def handle_run_pagila_query(params: Dict[str, Any]) -> Dict[str, Any]:
     else:
         truncated_query = query[:200] + "..."
     logger.debug(
-        "handle_run_pagila_query finished query=%r rows=%d duration=%.3fs",
+        "run_pagila_query_impl finished query=%r rows=%d duration=%.3fs",
         truncated_query,
-        len(rows) if isinstance(rows, list) else -1,
+        len(rows),
         duration,
     )
-    result = {"rows": rows}
+    result = {"columns": columns, "rows": rows}
     if note:
         result["note"] = note
     return result
 
 
+def _arrow_column(values: tuple) -> pa.Array:
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # types Arrow cannot infer (uuid, json, ...) travel as text
+        return pa.array([None if v is None else str(v) for v in values])
+
+
+def _to_arrow_ipc(columns: list, rows: list) -> bytes:
+    """Pack tuple rows into a single-batch Arrow IPC stream."""
+    if rows:
+        arrays = [_arrow_column(col) for col in zip(*rows)]
+    else:
+        arrays = [pa.array([]) for _ in columns]
+    table = pa.Table.from_arrays(arrays, names=columns)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def run_pagila_query_arrow(query: str) -> Dict[str, Any]:
+    """Like run_pagila_query_impl, but the rows come back as Arrow IPC bytes."""
+    result = run_pagila_query_impl(query)
+    result["arrow"] = _to_arrow_ipc(result.pop("columns"), result.pop("rows"))
+    return result
+
+
+def stream_pagila_query(req_id: Any, query: str) -> int:
+    """Write a run_pagila_query result to stdout as NDJSON while fetching it.
+
+    Framing: a header object ``{"id", "stream": {"columns": [...]}}``, then one
+    JSON array per row, then ``{"id", "end": true, "result": {...}}``. Any
+    object line (including an error response) terminates the stream.
+    """
+    query = _check_raw_query(query)
+    MAX_ROWS = int(os.getenv("MCP_MAX_ROWS", "1000"))
+    count = 0
+    note = None
+    with stream_query(query) as (columns, row_iter):
+        _write_line({"id": req_id, "stream": {"columns": columns}})
+        # rows are left to the buffered writer so output pipelines with fetching
+        for row in row_iter:
+            if count == MAX_ROWS:
+                note = f"Truncated results to first {MAX_ROWS} rows"
+                break
+            _write_line(row, flush=False)
+            count += 1
+    _write_line({"id": req_id, "end": True, "result": {"note": note} if note else {}})
+    return count
+
+
+def read_ndjson_stream(stdout: BinaryIO, header: Dict[str, Any]) -> Optional[dict]:
+    """Client side of stream_pagila_query: collect rows after ``header``.
+
+    ``stdout`` is anything with a bytes ``readline()`` (a pipe or a reader
+    that wraps one).
+
+    Returns the assembled ``{"id", "result"}`` response, the error object if
+    one arrives mid-stream, or None if the stream ends early.
+    """
+    rows = []
+    while True:
+        line = stdout.readline()
+        if not line:
+            return None
+        # rows are JSON arrays; any object ends the stream
+        if line[:1] == b"[":
+            rows.append(orjson.loads(line))
+            continue
+        end = orjson.loads(line)
+        if "error" in end:
+            return end
+        result = {"columns": header["stream"]["columns"], "rows": rows}
+        result.update(end.get("result") or {})
+        return {"id": header.get("id"), "result": result}
+
+
+async def handle_run_pagila_query(params: Dict[str, Any]) -> Dict[str, Any]:
+    query = params.get("query", "")
+    if params.get("format") == "arrow":
+        return await asyncio.to_thread(run_pagila_query_arrow, query)
+    return await asyncio.to_thread(run_pagila_query_impl, query)
+
+
 async def handle_execute_sql(params: Dict[str, Any]) -> Dict[str, Any]:
     """Execute parameterized SQL provided as {'sql': str, 'params': [..]}.
     This is safer for client-side generated SQL that includes placeholders.
@@ -355,8 +473,8 @@ async def handle_execute_sql(params: Dict[str, Any]) -> Dict[str, Any]:
 
     # execute with params (may be None)
     start = time.monotonic()
-    rows = await asyncio.to_thread(
-        run_query, sql, tuple(sql_params) if sql_params else None
+    columns, rows = await asyncio.to_thread(
+        run_query_columns, sql, tuple(sql_params) if sql_params else None
     )
     duration = time.monotonic() - start
 
@@ -375,16 +493,19 @@ async def handle_execute_sql(params: Dict[str, Any]) -> Dict[str, Any]:
         duration,
     )
 
-    result = {"rows": rows}
+    result = {"columns": columns, "rows": rows}
     if note:
         result["note"] = note
     return result
 
 
 async def handle_request(request: Dict[str, Any]) -> Dict[str, Any]:
-    method = request.get("method")
-    params = request.get("params") or {}
-    req_id = request.get("id")
+    return await dispatch(
+        request.get("id"), request.get("method"), request.get("params") or {}
+    )
+
+
+async def dispatch(req_id: Any, method: Any, params: Dict[str, Any]) -> Dict[str, Any]:
     logger.info("Request start id=%s method=%s params=%s", req_id, method, params)
     start = time.monotonic()
 
@@ -424,24 +545,45 @@ async def handle_request(request: Dict[str, Any]) -> Dict[str, Any]:
     return {"id": req_id, "result": result}
 
 
-async def server_loop() -> None:
-    logger.info("Pagila MCP server started")
+def _write_line(obj: Any, flush: bool = True) -> None:
+    """Write one JSON line to stdout (works with pipes)."""
+    sys.stdout.buffer.write(orjson.dumps(obj, default=json_default) + b"\n")
+    if flush:
+        sys.stdout.buffer.flush()
 
-    loop = asyncio.get_running_loop()
-    reader = asyncio.StreamReader()
-    protocol = asyncio.StreamReaderProtocol(reader)
-    await loop.connect_read_pipe(lambda: protocol, os.fdopen(0))
 
-    # No asyncio StreamWriter; write responses to stdout.buffer.
+async def handle_stream_request(request: Dict[str, Any]) -> None:
+    """Run a streaming run_pagila_query, writing rows as they are fetched."""
+    req_id = request.get("id")
+    params = request.get("params") or {}
+    logger.info("Stream start id=%s method=run_pagila_query", req_id)
+    start = time.monotonic()
+    count = await asyncio.to_thread(
+        stream_pagila_query, req_id, params.get("query", "")
+    )
+    logger.info(
+        "Stream done id=%s rows=%d duration=%.3fs",
+        req_id,
+        count,
+        time.monotonic() - start,
+    )
+
 
+async def _serve_json(reader: asyncio.StreamReader) -> None:
+    """Newline-delimited JSON framing (used by app.py and mcp_inspector)."""
     while True:
         line = await reader.readline()
         if not line:
             break
 
+        request = None
         try:
-            request = json.loads(line.decode("utf-8"))
+            request = orjson.loads(line)
             logger.debug("Received request: %s", request)
+            params = request.get("params") or {}
+            if request.get("method") == "run_pagila_query" and params.get("stream"):
+                await handle_stream_request(request)
+                continue
             response = await handle_request(request)
         except Exception as exc:
             logger.exception("Error handling request: %s", exc)
@@ -453,16 +595,81 @@ async def server_loop() -> None:
             # error response prepared
 
         # write response directly to stdout (works with pipes)
-        sys.stdout.buffer.write(
-            (json.dumps(response, default=_json_default) + "\n").encode("utf-8")
-        )
-        sys.stdout.buffer.flush()
+        _write_line(response)
+
+
+class Request(msgspec.Struct):
+    """msgpack request envelope; decoded straight into fields, no dict."""
+
+    id: Any = None
+    method: str = ""
+    params: Dict[str, Any] = {}
+
+
+_MSGPACK_DECODER = msgspec.msgpack.Decoder(Request)
+_MSGPACK_ENCODER = msgspec.msgpack.Encoder(
+    enc_hook=json_default, decimal_format="number"
+)
+
+
+def _write_frame(obj: Any) -> None:
+    """Write one length-prefixed msgpack frame to stdout."""
+    buf = _MSGPACK_ENCODER.encode(obj)
+    sys.stdout.buffer.write(struct.pack(">I", len(buf)) + buf)
+    sys.stdout.buffer.flush()
+
+
+async def _serve_msgpack(reader: asyncio.StreamReader) -> None:
+    """4-byte big-endian length prefix + msgpack body (used by streamlit_app)."""
+    while True:
+        try:
+            header = await reader.readexactly(4)
+            body = await reader.readexactly(struct.unpack(">I", header)[0])
+        except asyncio.IncompleteReadError:
+            break
+
+        req_id = None
+        try:
+            request = _MSGPACK_DECODER.decode(body)
+            req_id = request.id
+            logger.debug("Received request: %s", request)
+            response = await dispatch(request.id, request.method, request.params)
+        except Exception as exc:
+            logger.exception("Error handling request: %s", exc)
+            response = {"id": req_id, "error": {"message": str(exc)}}
+
+        _write_frame(response)
+
+
+async def server_loop(framing: str = "json") -> None:
+    logger.info("Pagila MCP server started framing=%s", framing)
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    await loop.connect_read_pipe(lambda: protocol, os.fdopen(0))
+
+    # No asyncio StreamWriter; write responses to stdout.buffer.
+    if framing == "msgpack":
+        await _serve_msgpack(reader)
+    else:
+        await _serve_json(reader)
 
     logger.info("Pagila MCP server stopped")
 
 
 def main() -> None:
-    asyncio.run(server_loop())
+    parser = argparse.ArgumentParser(description="Pagila MCP server over stdio")
+    parser.add_argument(
+        "--framing",
+        choices=("json", "msgpack"),
+        default="json",
+        help="wire format: JSON lines, or length-prefixed msgpack frames",
+    )
+    args = parser.parse_args()
+
+    configure_logging()
+    asyncio.run(server_loop(args.framing))
 
 
 if __name__ == "__main__":
@@ -11,74 +11,243 @@ Features:
 """
 from __future__ import annotations
 
-import json
+import atexit
+import io
 import os
+import struct
 import subprocess
 import sys
 import threading
 import time
-from queue import Queue
+from collections import OrderedDict, deque
+from itertools import count
 from typing import Optional
 
+import msgspec
+import pandas as pd
+import pyarrow as pa
 import streamlit as st
 
+STDERR_MAXLEN = 500
+STDERR_SHOWN = 20
+STDERR_PREFIX = b"[mcp-server-stderr] "
 
-def _start_server() -> tuple[subprocess.Popen, Queue]:
+
+def _start_server() -> tuple[subprocess.Popen, deque]:
     venv_python = os.path.join(os.getcwd(), ".venv", "bin", "python")
     python_exe = venv_python if os.path.exists(venv_python) else sys.executable
-    cmd = [python_exe, "mcp_pagila_server.py"]
+    cmd = [python_exe, "mcp_pagila_server.py", "--framing", "msgpack"]
+    # binary pipes: frames are bytes on both ends, no TextIOWrapper in between
     proc = subprocess.Popen(
         cmd,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        text=True,
-        bufsize=1,
+        bufsize=io.DEFAULT_BUFFER_SIZE,
     )
 
-    stderr_q: Queue = Queue()
+    # bounded; append and list() copies are atomic, so no extra locking.
+    # Entries are ("line", text) or ("exit", returncode).
+    stderr_q: deque = deque(maxlen=STDERR_MAXLEN)
 
     def _forward_stderr():
         assert proc.stderr is not None
+        out = sys.stderr.buffer
         for ln in proc.stderr:
-            line = ln.rstrip("\n")
-            # keep server logs visible in console for local debugging
-            print("[mcp-server-stderr] " + line, file=sys.stderr)
-            try:
-                stderr_q.put_nowait(line)
-            except Exception:
-                pass
-
-    t = threading.Thread(target=_forward_stderr, daemon=True)
-    t.start()
+            # keep server logs visible in console for local debugging; the raw
+            # bytes go straight through, only the sidebar copy is decoded
+            out.write(STDERR_PREFIX + ln)
+            out.flush()
+            stderr_q.append(("line", ln.decode("utf-8", "replace").rstrip("\n")))
+
+    def _monitor_exit():
+        # block in waitpid until the child dies, then post a single event
+        rc = proc.wait()
+        stderr_q.append(("exit", rc))
+
+    threading.Thread(target=_forward_stderr, daemon=True).start()
+    threading.Thread(target=_monitor_exit, daemon=True).start()
     return proc, stderr_q
 
 
-def _send_request(proc: subprocess.Popen, request: dict) -> Optional[dict]:
-    assert proc.stdin is not None and proc.stdout is not None
-    line = json.dumps(request, default=str) + "\n"
-    try:
-        proc.stdin.write(line)
-        proc.stdin.flush()
-    except Exception as exc:
-        st.error(f"Failed to write to MCP server stdin: {exc}")
+def _read_frame(proc: subprocess.Popen) -> Optional[bytes]:
+    """Read one length-prefixed msgpack frame; None on EOF."""
+    assert proc.stdout is not None
+    header = proc.stdout.read(4)
+    if len(header) < 4:
         return None
+    size = struct.unpack(">I", header)[0]
+    body = proc.stdout.read(size)
+    return body if len(body) == size else None
+
 
+def _stop_proc(proc: Optional[subprocess.Popen]) -> None:
+    """Terminate ``proc`` and reap it, escalating to kill after 2s."""
+    if proc is None or proc.poll() is not None:
+        return
     try:
-        resp_line = proc.stdout.readline()
-        if not resp_line:
-            st.error("MCP server closed stdout or exited")
+        proc.terminate()
+        proc.wait(timeout=2)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    except Exception:
+        pass
+
+
+def _cleanup(server: dict) -> None:
+    _stop_proc(server["proc"])
+    server["proc"] = None
+
+
+@st.cache_resource
+def _mcp_server() -> dict:
+    """Process-wide holder for the one MCP subprocess shared by all sessions."""
+    server = {
+        "proc": None,
+        "stderr_q": None,
+        # exit/backoff bookkeeping is shared too, so every session sees it
+        "failures": 0,
+        "backoff_until": 0.0,
+        "needs_restart": False,
+        "lock": threading.Lock(),
+        "io_lock": threading.Lock(),
+        "ids": count(1),
+    }
+    # don't leave the server (and its DB pool) behind when Streamlit exits;
+    # Streamlit's own SIGTERM handling shuts down through atexit as well
+    atexit.register(_cleanup, server)
+    return server
+
+
+def _check_exit(server: dict) -> None:
+    """Count a dead server once and start its backoff (caller holds the lock)."""
+    proc = server["proc"]
+    if proc is None or server["needs_restart"] or proc.poll() is None:
+        return
+    server["failures"] += 1
+    server["backoff_until"] = time.monotonic() + min(300, 2 ** server["failures"])
+    server["needs_restart"] = True
+
+
+def _spawn(server: dict) -> None:
+    server["proc"], server["stderr_q"] = _start_server()
+    server["needs_restart"] = False
+
+
+def _server_state() -> dict:
+    """Snapshot of the shared server state; never starts the process."""
+    server = _mcp_server()
+    with server["lock"]:
+        _check_exit(server)
+        return {
+            k: server[k]
+            for k in ("proc", "stderr_q", "failures", "backoff_until", "needs_restart")
+        }
+
+
+def _get_proc() -> Optional[subprocess.Popen]:
+    """Return the shared server process, starting it on first request.
+
+    A dead server is respawned once its backoff has passed; until then this
+    returns None.
+    """
+    server = _mcp_server()
+    with server["lock"]:
+        _check_exit(server)
+        if server["proc"] is None:
+            _spawn(server)
+        elif server["needs_restart"]:
+            if time.monotonic() < server["backoff_until"]:
+                return None
+            _spawn(server)
+        return server["proc"]
+
+
+def _restart_server() -> None:
+    server = _mcp_server()
+    # lock only: waiting for io_lock here would stall every session behind a
+    # wedged request. Killing the child makes a blocked _read_frame see EOF,
+    # so the in-flight request fails instead.
+    with server["lock"]:
+        _stop_proc(server["proc"])
+        _spawn(server)
+        server["failures"] = 0
+
+
+def _send_request(request: dict) -> Optional[dict]:
+    server = _mcp_server()
+    proc = _get_proc()
+    if proc is None:
+        st.error("MCP server exited; waiting for the restart backoff to pass")
+        return None
+    assert proc.stdin is not None and proc.stdout is not None
+    req_id = next(server["ids"])
+    # requests carry only msgpack-native values (SQL text, params echoed back
+    # from the server), so no enc_hook fallback is needed
+    body = msgspec.msgpack.encode({**request, "id": req_id})
+    # sessions share the pipe; keep each write/read pair together
+    with server["io_lock"]:
+        try:
+            proc.stdin.write(struct.pack(">I", len(body)) + body)
+            proc.stdin.flush()
+        except Exception as exc:
+            st.error(f"Failed to write to MCP server stdin: {exc}")
+            return None
+
+        try:
+            frame = _read_frame(proc)
+            if frame is None:
+                st.error("MCP server closed stdout or exited")
+                return None
+            resp = msgspec.msgpack.decode(frame)
+        except Exception as exc:
+            st.error(f"Failed to read/parse MCP response: {exc}")
             return None
-        return json.loads(resp_line)
-    except Exception as exc:
-        st.error(f"Failed to read/parse MCP response: {exc}")
+
+    if isinstance(resp, dict) and resp.get("id") not in (req_id, None):
+        st.error(f"MCP response id {resp.get('id')} does not match request {req_id}")
         return None
+    return resp
+
+
+SQL_CACHE_SIZE = 256
+
 
+def _text_to_sql(text: str) -> Optional[dict]:
+    """Round-trip ``text_to_sql``, memoized per session on the normalized prompt.
 
-def _fmt_relative(ts: float) -> str:
+    The local generator lowercases its input, so case-only variants share an
+    entry. Error responses are not cached.
+    """
+    cache = st.session_state.setdefault("_sql_cache", OrderedDict())
+    key = text.strip().lower()
+    resp = cache.get(key)
+    if resp is not None:
+        cache.move_to_end(key)
+        return resp
+
+    resp = _send_request(
+        {
+            "method": "text_to_sql",
+            "params": {"text": text, "execute": False, "provider": "local"},
+        }
+    )
+    if isinstance(resp, dict) and "result" in resp:
+        cache[key] = resp
+        if len(cache) > SQL_CACHE_SIZE:
+            cache.popitem(last=False)
+    return resp
+
+
+REL_LABEL_TTL = 30.0
+
+
+def _fmt_relative(ts: float, now: Optional[float] = None) -> str:
     """Format a timestamp as a relative string (e.g. '2m ago')."""
     try:
-        now = time.time()
+        if now is None:
+            now = time.time()
         diff = int(now - float(ts))
     except Exception:
         return ""
@@ -96,6 +265,99 @@ def _fmt_relative(ts: float) -> str:
     return f"{days}d ago"
 
 
+MAX_HISTORY = 200
+VISIBLE_BLOCKS = 20
+
+
+def _to_frame(rows: Optional[list], columns: Optional[list]) -> Optional[pd.DataFrame]:
+    """Build the result DataFrame once, when the message is recorded."""
+    if not rows:
+        return None
+    try:
+        return pd.DataFrame(rows, columns=columns)
+    except Exception:
+        return None
+
+
+def _append_history(msg: dict) -> None:
+    """Append a chat message, keeping only the newest MAX_HISTORY entries.
+
+    ``st.session_state.blocks`` (user-first groups of messages) is updated in
+    step so the render loop never has to regroup the whole history.
+    """
+    history = st.session_state.history
+    blocks = st.session_state.blocks
+    history.append(msg)
+    if msg.get("role") == "user" or not blocks:
+        blocks.append([msg])
+    else:
+        blocks[-1].append(msg)
+
+    excess = len(history) - MAX_HISTORY
+    if excess > 0:
+        del history[:excess]
+        while excess:
+            first = blocks[0]
+            drop = min(excess, len(first))
+            del first[:drop]
+            excess -= drop
+            if not first:
+                del blocks[0]
+
+
+def _render_block(block: list[dict], now: float) -> None:
+    """Render one user-first group of messages.
+
+    Relative timestamp labels are cached per message and only recomputed once
+    they are REL_LABEL_TTL seconds stale.
+    """
+    st.markdown("---")
+    for msg in block:
+        text = msg.get("text")
+        meta = msg.get("meta") or {}
+        ts = msg.get("ts")
+        # separator and relative timestamp
+        if ts:
+            label = msg.get("_rel_cache")
+            if label is None or now - msg.get("_rel_cache_at", 0) > REL_LABEL_TTL:
+                label = _fmt_relative(ts, now)
+                msg["_rel_cache"] = label
+                msg["_rel_cache_at"] = now
+            st.caption(label)
+
+        # lightweight avatar using native Streamlit columns (faster than HTML)
+        av_col, msg_col = st.columns([0.07, 0.93])
+        with av_col:
+            st.markdown("**You**" if msg.get("role") == "user" else "**AI**")
+        with msg_col:
+            # render message text plainly (faster); preserve code blocks below
+            try:
+                st.write(text)
+            except Exception:
+                st.text(text)
+
+        if not meta:
+            continue
+        sql = meta.get("sql")
+        if sql:
+            st.code(sql, language="sql")
+        note = meta.get("note")
+        if note:
+            st.info(note)
+        error = meta.get("error")
+        if error:
+            st.error(error)
+        df = msg.get("_df")
+        if df is not None:
+            try:
+                st.dataframe(df)
+            except Exception:
+                try:
+                    st.write(df)
+                except Exception:
+                    st.text(str(df))
+
+
 # --- Streamlit UI
 st.set_page_config(page_title="Pagila MCP Chat", layout="wide")
 st.title("Pagila MCP — Chat UI")
@@ -104,37 +366,14 @@ st.caption(
 )
 
 # ensure server subprocess in session state
-if "mcp_proc" not in st.session_state:
-    proc, stderr_q = _start_server()
-    st.session_state.mcp_proc = proc
-    st.session_state.mcp_stderr_q = stderr_q
+if "history" not in st.session_state:
     st.session_state.history = []
-
-    # monitor thread posts events into stderr queue for main thread handling
-    def _monitor_loop():
-        while True:
-            proc_ref = st.session_state.get("mcp_proc")
-            if proc_ref is None:
-                time.sleep(1)
-                continue
-            try:
-                if proc_ref.poll() is not None:
-                    try:
-                        st.session_state.mcp_stderr_q.put_nowait(
-                            f"EVENT:EXIT:{proc_ref.returncode}"
-                        )
-                    except Exception:
-                        pass
-            except Exception:
-                pass
-            time.sleep(1)
-
-    mon = threading.Thread(target=_monitor_loop, daemon=True)
-    mon.start()
+    st.session_state.blocks = []
 
 
 # Sidebar
 with st.sidebar:
+    ss = st.session_state
     st.header("Samples")
     samples = [
         "Show film titles from 2010 limit 3",
@@ -144,8 +383,8 @@ with st.sidebar:
     ]
     for s in samples:
         if st.button(s):
-            st.session_state._pending_sample = s
-            st.session_state._pending_execute = True
+            ss._pending_sample = s
+            ss._pending_execute = True
 
     st.markdown("---")
     st.header("Options")
@@ -155,106 +394,58 @@ with st.sidebar:
     st.markdown("---")
 
     st.write("Server status:")
-    proc = st.session_state.mcp_proc
-    stderr_q = st.session_state.get("mcp_stderr_q")
-    running = proc.poll() is None
-    st.write("PID: %s — Running: %s" % (getattr(proc, "pid", None), running))
+    server = _server_state()
+    proc, stderr_q = server["proc"], server["stderr_q"]
+    if proc is None:
+        st.write("Not started (starts on first request)")
+    else:
+        running = proc.poll() is None
+        st.write("PID: %s — Running: %s" % (proc.pid, running))
     if st.button("Restart server"):
-        try:
-            if proc and proc.poll() is None:
-                proc.terminate()
-        except Exception:
-            pass
-        new_proc, new_q = _start_server()
-        st.session_state.mcp_proc = new_proc
-        st.session_state.mcp_stderr_q = new_q
+        _restart_server()
         st.success("Server restarted")
 
     st.markdown("**Server stderr (recent):**")
-    if "mcp_failure_count" not in st.session_state:
-        st.session_state.mcp_failure_count = 0
-        st.session_state.mcp_restart_backoff_until = 0.0
-        st.session_state.mcp_needs_restart = False
-
-    human_lines = []
-    if stderr_q:
-        lines = []
-        try:
-            while len(lines) < 200:
-                lines.append(stderr_q.get_nowait())
-        except Exception:
-            pass
-        for ln in lines:
-            if isinstance(ln, str) and ln.startswith("EVENT:EXIT:"):
-                try:
-                    code = int(ln.split(":")[-1])
-                except Exception:
-                    code = None
-                st.session_state.mcp_failure_count = (
-                    st.session_state.get("mcp_failure_count", 0) + 1
-                )
-                now = time.time()
-                attempts = st.session_state.mcp_failure_count
-                backoff = min(300, 2**attempts)
-                st.session_state.mcp_restart_backoff_until = now + backoff
-                st.session_state.mcp_needs_restart = True
-                human_lines.append(
-                    f"MCP server exited (code={code}); backoff {backoff}s"
-                )
+    if stderr_q is not None:
+        # the buffer is shared by every session: read its tail, don't drain it
+        human_lines = []
+        for kind, payload in list(stderr_q)[-STDERR_SHOWN:]:
+            if kind == "exit":
+                human_lines.append(f"MCP server exited (code={payload})")
             else:
-                human_lines.append(str(ln))
+                human_lines.append(payload)
 
         if human_lines:
-            for ln in human_lines[-20:]:
+            for ln in human_lines:
                 st.text(ln)
         else:
             st.write("(no recent server stderr)")
     else:
         st.write("(no server stderr queue)")
 
-    if st.session_state.get("mcp_needs_restart"):
-        backoff_until = st.session_state.get("mcp_restart_backoff_until", 0)
-        now = time.time()
-        if now < backoff_until:
-            diff = int(backoff_until - now)
+    if server["needs_restart"]:
+        failure_count = server["failures"]
+        # backoff is an interval, so measure it on the monotonic clock
+        remaining = server["backoff_until"] - time.monotonic()
+        if remaining > 0:
             st.warning(
                 (
-                    f"Server exited; restart allowed in {diff}s. "
-                    f"(failures={st.session_state.get('mcp_failure_count')})"
+                    f"Server exited; restart allowed in {int(remaining)}s. "
+                    f"(failures={failure_count})"
                 )
             )
             if st.button("Force restart now (override backoff)"):
-                proc = st.session_state.get("mcp_proc")
-                try:
-                    if proc and proc.poll() is None:
-                        proc.terminate()
-                except Exception:
-                    pass
-                new_proc, new_q = _start_server()
-                st.session_state.mcp_proc = new_proc
-                st.session_state.mcp_stderr_q = new_q
-                st.session_state.mcp_needs_restart = False
-                st.session_state.mcp_failure_count = 0
+                _restart_server()
                 st.success("Server force-restarted")
         else:
             st.warning(
                 (
-                    "Server exited; restart available now. "
-                    f"(failures={st.session_state.get('mcp_failure_count')})"
+                    "Server exited; it restarts on the next request. "
+                    f"(failures={failure_count})"
                 )
             )
             if st.button("Restart server now"):
-                proc = st.session_state.get("mcp_proc")
-                try:
-                    if proc and proc.poll() is None:
-                        proc.terminate()
-                except Exception:
-                    pass
-                new_proc, new_q = _start_server()
-                st.session_state.mcp_proc = new_proc
-                st.session_state.mcp_stderr_q = new_q
-                st.session_state.mcp_needs_restart = False
-                st.session_state.mcp_failure_count = 0
+                _restart_server()
                 st.success("Server restarted")
 
 
@@ -278,16 +469,18 @@ with col1:
     submit = st.button("Send")
 
     if submit and user_input:
-        st.session_state.history.append(
-            {"role": "user", "text": user_input, "ts": time.time()}
-        )
+        _append_history({"role": "user", "text": user_input, "ts": time.time()})
         # immediate handling (run: path or NLP path)
         if user_input.lower().strip().startswith("run:"):
             sql = user_input.split(":", 1)[1].strip()
-            req = {"id": 1, "method": "run_pagila_query", "params": {"query": sql}}
-            resp = _send_request(st.session_state.mcp_proc, req)
+            # raw queries can be large: ask for the rows as an Arrow IPC stream
+            req = {
+                "method": "run_pagila_query",
+                "params": {"query": sql, "format": "arrow"},
+            }
+            resp = _send_request(req)
             if resp is None:
-                st.session_state.history.append(
+                _append_history(
                     {
                         "role": "assistant",
                         "text": "No response from MCP server.",
@@ -297,34 +490,28 @@ with col1:
             else:
                 result = resp.get("result") if isinstance(resp, dict) else None
                 error = resp.get("error") if isinstance(resp, dict) else None
-                rows = (
-                    result.get("rows")
-                    if isinstance(result, dict) and "rows" in result
-                    else None
-                )
+                table = None
                 meta = {"sql": sql}
-                if rows is not None:
-                    meta["rows"] = rows
+                if isinstance(result, dict) and "arrow" in result:
+                    table = pa.ipc.open_stream(result["arrow"]).read_all()
+                    meta["row_count"] = table.num_rows
                 if error:
                     meta["error"] = error
-                st.session_state.history.append(
+                _append_history(
                     {
                         "role": "assistant",
                         "text": "Executed SQL",
                         "meta": meta,
                         "ts": time.time(),
+                        # st.dataframe takes the Arrow table as is
+                        "_df": table if table is not None and table.num_rows else None,
                     }
                 )
         else:
             desired_execute = execute_sql or sample_exec
-            gen_req = {
-                "id": 1,
-                "method": "text_to_sql",
-                "params": {"text": user_input, "execute": False, "provider": "local"},
-            }
-            resp = _send_request(st.session_state.mcp_proc, gen_req)
+            resp = _text_to_sql(user_input)
             if resp is None:
-                st.session_state.history.append(
+                _append_history(
                     {
                         "role": "assistant",
                         "text": "No response from MCP server.",
@@ -341,7 +528,7 @@ with col1:
                 )
 
                 if not confident:
-                    st.session_state.history.append(
+                    _append_history(
                         {
                             "role": "assistant",
                             "text": (
@@ -353,13 +540,12 @@ with col1:
                         }
                     )
                 else:
-                    st.session_state.history.append(
+                    _append_history(
                         {
                             "role": "assistant",
                             "text": note or "Generated SQL",
                             "meta": {
                                 "sql": sql,
-                                "rows": None,
                                 "params": params,
                                 "confident": confident,
                             },
@@ -368,13 +554,12 @@ with col1:
                     )
                     if desired_execute:
                         exec_req = {
-                            "id": 1,
                             "method": "execute_sql",
                             "params": {"sql": sql, "params": params},
                         }
-                        exec_resp = _send_request(st.session_state.mcp_proc, exec_req)
+                        exec_resp = _send_request(exec_req)
                         if exec_resp is None:
-                            st.session_state.history.append(
+                            _append_history(
                                 {
                                     "role": "assistant",
                                     "text": "No response from MCP server on execute.",
@@ -395,72 +580,40 @@ with col1:
                             )
                             last = st.session_state.history[-1]
                             last_meta = last.setdefault("meta", {})
-                            last_meta["rows"] = rows
+                            # keep only the frame: raw rows would sit in session state twice
+                            last_meta["row_count"] = len(rows) if rows else 0
+                            last["_df"] = _to_frame(
+                                rows,
+                                (
+                                    exec_res.get("columns")
+                                    if isinstance(exec_res, dict)
+                                    else None
+                                ),
+                            )
                             if exec_note:
                                 last_meta["note"] = exec_note
 
-    # Sort history by timestamp (ascending) to get chronological order,
-    # then group into user-first blocks. This avoids cases where timestamps
-    # or list ordering produce assistant-before-user rendering.
-    sorted_hist = sorted(st.session_state.history, key=lambda m: m.get("ts", 0))
-    blocks: list[list[dict]] = []
-    current: list[dict] = []
-    for m in sorted_hist:
-        if m.get("role") == "user":
-            if current:
-                blocks.append(current)
-            current = [m]
-        else:
-            if not current:
-                current = [m]
-            else:
-                current.append(m)
-    if current:
-        blocks.append(current)
+    blocks = st.session_state.blocks
 
-    # render newest block first
-    for block in reversed(blocks):
+    # render newest block first; older blocks only cost widgets when asked for
+    now = time.time()
+    newest_first = blocks[::-1]
+    for block in newest_first[:VISIBLE_BLOCKS]:
+        _render_block(block, now)
+    older = newest_first[VISIBLE_BLOCKS:]
+    if older:
         st.markdown("---")
-        for msg in block:
-            role = msg.get("role")
-            text = msg.get("text")
-            meta = msg.get("meta", {})
-            ts = msg.get("ts")
-            # separator and relative timestamp
-            if ts:
-                st.caption(_fmt_relative(ts))
-
-            # lightweight avatar using native Streamlit columns (faster than HTML)
-            av_col, msg_col = st.columns([0.07, 0.93])
-            with av_col:
-                if role == "user":
-                    st.markdown("**You**")
-                else:
-                    st.markdown("**AI**")
-            with msg_col:
-                # render message text plainly (faster); preserve code blocks below
-                try:
-                    st.write(text)
-                except Exception:
-                    st.text(text)
-
-            if meta.get("sql"):
-                st.code(meta["sql"], language="sql")
-            if meta.get("note"):
-                st.info(meta.get("note"))
-            if meta.get("error"):
-                st.error(meta.get("error"))
-            if meta.get("rows"):
-                try:
-                    st.dataframe(meta["rows"])
-                except Exception:
-                    st.write(meta["rows"])
+        if st.checkbox(f"Show {len(older)} older conversation blocks"):
+            for block in older:
+                _render_block(block, now)
 
 with col2:
     st.subheader("Details / Last response")
     if st.session_state.history:
         last = st.session_state.history[-1]
-        st.json(last, expanded=False)
+        st.json(
+            {k: v for k, v in last.items() if not k.startswith("_")}, expanded=False
+        )
     else:
         st.write("No messages yet.")
 
@@ -0,0 +1,17 @@
+from db import unique_columns
+
+
+def test_unique_columns_suffixes_duplicates():
+    names = ["film_id", "title", "film_id", "last_update", "film_id", "last_update"]
+    assert unique_columns(names) == [
+        "film_id",
+        "title",
+        "film_id_1",
+        "last_update",
+        "film_id_2",
+        "last_update_1",
+    ]
+
+
+def test_unique_columns_skips_existing_suffix():
+    assert unique_columns(["id", "id_1", "id"]) == ["id", "id_1", "id_2"]
@@ -12,10 +12,19 @@ SAMPLES = [
 ]
 
 
+@pytest.fixture(scope="module")
+def loop():
+    # one event loop (and its default executor) shared by every test here
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.run_until_complete(loop.shutdown_default_executor())
+    loop.close()
+
+
 @pytest.mark.parametrize("text", SAMPLES)
-def test_text_to_sql_generates_and_executes(text):
+def test_text_to_sql_generates_and_executes(loop, text):
     # call the async handler directly; it will use the DB configured via config.env
-    res = asyncio.run(
+    res = loop.run_until_complete(
         handle_text_to_sql({"text": text, "execute": True, "provider": "local"})
     )
     assert isinstance(res, dict)
@@ -27,21 +36,23 @@ def test_text_to_sql_generates_and_executes(text):
     assert "error" not in res
 
 
-def test_forbidden_raw_queries_rejected():
+def test_forbidden_raw_queries_rejected(loop):
     # DROP statement should be rejected
     with pytest.raises(ValueError):
-        asyncio.run(handle_run_pagila_query({"query": "DROP TABLE film"}))
+        loop.run_until_complete(handle_run_pagila_query({"query": "DROP TABLE film"}))
 
 
-def test_multiple_statements_rejected():
+def test_multiple_statements_rejected(loop):
     with pytest.raises(ValueError):
-        asyncio.run(handle_run_pagila_query({"query": "SELECT 1; SELECT 2"}))
+        loop.run_until_complete(
+            handle_run_pagila_query({"query": "SELECT 1; SELECT 2"})
+        )
 
 
-def test_truncation_note(monkeypatch):
+def test_truncation_note(loop, monkeypatch):
     # set max rows to 2 and request more rows; expect note present
     monkeypatch.setenv("MCP_MAX_ROWS", "2")
-    res = asyncio.run(
+    res = loop.run_until_complete(
         handle_run_pagila_query({"query": "SELECT title FROM film LIMIT 5"})
     )
     assert isinstance(res, dict)
@@ -0,0 +1,112 @@
+import io
+import os
+import struct
+import subprocess
+import sys
+import uuid
+from decimal import Decimal
+
+import msgspec
+import orjson
+import pyarrow as pa
+import pytest
+
+import mcp_pagila_server as server
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SERVER_SCRIPT = os.path.join(ROOT, "mcp_pagila_server.py")
+
+
+def _spawn(tmp_path, *args):
+    return subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, *args],
+        cwd=ROOT,
+        env={**os.environ, "LOG_DIR": str(tmp_path)},
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def test_arrow_ipc_round_trip():
+    ident = uuid.uuid4()
+    buf = server._to_arrow_ipc(
+        ["film_id", "rental_rate", "ref"],
+        [(1, Decimal("4.99"), ident), (2, None, None)],
+    )
+    table = pa.ipc.open_stream(buf).read_all()
+    assert table.column_names == ["film_id", "rental_rate", "ref"]
+    assert table.column("film_id").to_pylist() == [1, 2]
+    assert table.column("rental_rate").to_pylist() == [Decimal("4.99"), None]
+    assert table.column("ref")[1].as_py() is None
+    assert str(table.column("ref")[0]).replace("-", "").lower() == ident.hex
+
+
+def test_arrow_ipc_empty_result():
+    table = pa.ipc.open_stream(server._to_arrow_ipc(["title"], [])).read_all()
+    assert table.column_names == ["title"]
+    assert table.num_rows == 0
+
+
+def test_check_raw_query_strips_trailing_semicolon():
+    assert (
+        server._check_raw_query("  SELECT title FROM film; ")
+        == "SELECT title FROM film"
+    )
+
+
+def test_json_lines_error_response(tmp_path):
+    proc = _spawn(tmp_path)
+    out, _ = proc.communicate(b'{"id": 7, "method": "nope"}\nnot json\n', timeout=30)
+    first, second = [orjson.loads(line) for line in out.splitlines()]
+    assert first == {"id": 7, "error": {"message": "Unknown method: nope"}}
+    assert second["id"] is None and "message" in second["error"]
+
+
+def test_msgpack_error_response(tmp_path):
+    proc = _spawn(tmp_path, "--framing", "msgpack")
+    body = msgspec.msgpack.encode({"id": 7, "method": "nope", "params": {}})
+    out, _ = proc.communicate(struct.pack(">I", len(body)) + body, timeout=30)
+    (size,) = struct.unpack(">I", out[:4])
+    assert len(out) == 4 + size
+    resp = msgspec.msgpack.decode(out[4:])
+    assert resp == {"id": 7, "error": {"message": "Unknown method: nope"}}
+
+
+@pytest.fixture
+def header():
+    return {"id": 3, "stream": {"columns": ["film_id", "title"]}}
+
+
+def test_ndjson_stream_assembles_rows(header):
+    stdout = io.BytesIO(
+        b'[1,"ACADEMY DINOSAUR"]\n[2,"ACE GOLDFINGER"]\n'
+        b'{"id":3,"end":true,"result":{"note":"Truncated results to first 2 rows"}}\n'
+    )
+    assert server.read_ndjson_stream(stdout, header) == {
+        "id": 3,
+        "result": {
+            "columns": ["film_id", "title"],
+            "rows": [[1, "ACADEMY DINOSAUR"], [2, "ACE GOLDFINGER"]],
+            "note": "Truncated results to first 2 rows",
+        },
+    }
+
+
+def test_ndjson_stream_ends_on_error_line(header):
+    stdout = io.BytesIO(
+        b'[1,"ACADEMY DINOSAUR"]\n'
+        b'{"id":3,"error":{"message":"canceling statement"}}\n'
+        b'[2,"ACE GOLDFINGER"]\n'
+    )
+    resp = server.read_ndjson_stream(stdout, header)
+    assert resp == {"id": 3, "error": {"message": "canceling statement"}}
+    # nothing after the error line is consumed as part of this response
+    assert stdout.readline() == b'[2,"ACE GOLDFINGER"]\n'
+
+
+def test_ndjson_stream_truncated(header):
+    assert (
+        server.read_ndjson_stream(io.BytesIO(b'[1,"ACADEMY DINOSAUR"]\n'), header)
+        is None
+    )